@@ -28,6 +28,7 @@ class Model(DataClass):
     input_embedding_std: float = 1.
     position_embedding_std: float = 1.
     float16: bool = False
+    autocast: bool = False  # run convolutions in bfloat16 while keeping float32 weights and a float32 cumsum
     device: str = 'cuda:0' if torch.cuda.is_available() else 'cpu'
     conv_kernel_size: int = 7
     feed_forward_intermediate_factor: float = 2.
@@ -46,7 +47,7 @@ class Dataset(DataClass):
     classes: int = 256
     shuffle: bool = False
     num_workers: int = 4
-    pin_memory: bool = False
+    pin_memory: bool = True
     prefetch_factor: int = 2
 
 
@@ -8,7 +8,6 @@ from src.dataclass import Context
 @torch.jit.script
 def get_sample(data: torch.Tensor, batch_index: torch.Tensor, idx: int) -> typing.Tuple[torch.Tensor, torch.Tensor]:
     dat = data[batch_index + idx]
-    dat = dat.to(dtype=torch.long, non_blocking=True)
     return dat[:, :-1], dat[:, 1:]
 
 
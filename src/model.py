@@ -1,3 +1,5 @@
+import contextlib
+import functools
 import math
 import typing
 
@@ -17,21 +19,24 @@ def orthonormal(inp: typing.Union[torch.Tensor, torch.nn.Parameter], gain: float
     if isinstance(inp, torch.nn.Parameter):
         inp = inp.data
     flat_shape = (inp.shape[0], np.prod(inp.shape[1:]))
-    a = torch.rand(flat_shape)
-    u, _, v = torch.linalg.svd(a, full_matrices=False)
-    inp.copy_((u if u.shape == flat_shape else v).reshape(inp.shape).mul(gain).to(device=inp.device, dtype=inp.dtype))
+    wide = flat_shape[0] < flat_shape[1]
+    a = torch.rand(flat_shape[::-1] if wide else flat_shape)
+    q = torch.linalg.householder_product(*torch.geqrf(a))  # Q only, without forming R or singular values
+    if wide:
+        q = q.t()
+    inp.copy_(q.reshape(inp.shape).mul(gain).to(device=inp.device, dtype=inp.dtype))
     return original_input
 
 
-def norm(out: torch.Tensor) -> torch.Tensor:
-    out = out - out.mean(1, keepdim=True)
-    return out / (torch.norm(out, 2, 1, True) * out.size(1) ** -0.5 + 1e-5)
+def norm(out: torch.Tensor, gain: float = 1.) -> torch.Tensor:
+    std, mean = torch.std_mean(out, 1, unbiased=False, keepdim=True)  # std == norm(out - mean) * size ** -0.5
+    return (out - mean) * (gain / (std + 1e-5))
 
 
 def conv(inp: torch.Tensor, weight: torch.Tensor, groups: int) -> torch.Tensor:
     pad = weight.size()[-1] - 1
-    if pad:
-        inp = torch.nn.functional.pad(inp, (pad, 0))
+    if pad:  # pad inside the conv instead of materialising a padded copy, then drop the non-causal tail
+        return torch.nn.functional.conv1d(inp, weight, padding=pad, groups=groups)[:, :, :-pad]
     return torch.nn.functional.conv1d(inp, weight, groups=groups)
 
 
@@ -50,9 +55,9 @@ def drop_conv(inp: torch.Tensor, weight: torch.Tensor, p: float, train: bool, gr
 
 
 @torch.jit.script
-def linear_attention(inp: torch.Tensor, divisor: torch.Tensor, w0: torch.Tensor, w1: torch.Tensor, w2: torch.Tensor,
-                     init_scale: float, cumsum_cache: torch.Tensor, dropout_probability: float, training: bool,
-                     groups: int, caching: bool, input_cache: torch.Tensor,
+def linear_attention(inp: torch.Tensor, inv_divisor: torch.Tensor, w0: torch.Tensor, w1: torch.Tensor,
+                     w2: torch.Tensor, init_scale: float, cumsum_cache: torch.Tensor, dropout_probability: float,
+                     training: bool, groups: int, caching: bool, input_cache: torch.Tensor,
                      idx: int) -> typing.Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
     kernel_size = w1.size(2)
     if not training and caching:
@@ -65,11 +70,11 @@ def linear_attention(inp: torch.Tensor, divisor: torch.Tensor, w0: torch.Tensor,
     inp = torch.relu(inp)
     inp = drop_conv(inp, w2, dropout_probability, training, groups)
     depth, scale, shift = inp.chunk(groups, 1)
-    cum = depth.cumsum(1)
+    cum = depth.to(inv_divisor.dtype).cumsum(1)  # keep the running sum in full precision under autocast
     if not training and caching:
         cum = cum + cumsum_cache
         cumsum_cache = cum[:, :, -kernel_size - 1].detach()
-    return input_cache, cumsum_cache, norm(cum / divisor * scale + shift) * init_scale
+    return input_cache, cumsum_cache, norm(cum * inv_divisor * scale + shift, init_scale)
 
 
 def get_coupling(beta_tmp: float):
@@ -81,19 +86,20 @@ def get_coupling(beta_tmp: float):
     def momentum_coupling_inverse(output: torch.Tensor, fn_out: torch.Tensor, beta: float) -> torch.Tensor:
         return (output - fn_out * (1 - beta)) / beta
 
-    def _wrapped_momentum_coupling_forward(x, y):
-        return momentum_coupling_forward(x, y, beta_tmp)
-
-    def _wrapped_momentum_coupling_inverse(x, y):
-        return momentum_coupling_inverse(x, y, beta_tmp)
-
-    return _wrapped_momentum_coupling_forward, _wrapped_momentum_coupling_inverse
+    return (functools.partial(momentum_coupling_forward, beta=beta_tmp),
+            functools.partial(momentum_coupling_inverse, beta=beta_tmp))
 
 
 def conv_weight(in_features: int, out_features: int, kernel_size: int, groups: int, std: float):
     return orthonormal(torch.nn.Conv1d(in_features, out_features, (kernel_size,), groups=groups).weight, 1 / std)
 
 
+def _drop_legacy_divisor(module: torch.nn.Module, state_dict: typing.Dict[str, torch.Tensor], prefix: str, *args):
+    # State dicts saved before the divisor became a derived per-cell buffer still carry a "divisor" entry.
+    # Dropping it keeps load_state_dict(strict=True) working on those checkpoints.
+    state_dict.pop(prefix + "divisor", None)
+
+
 class LinearAttention(torch.nn.Module):
     """
     One idea would be to run linear attention at every step in an rnn
@@ -101,18 +107,18 @@ class LinearAttention(torch.nn.Module):
 
     def __init__(self, ctx: Context):
         super(LinearAttention, self).__init__()
+        if ctx.model.autocast and ctx.model.float16:
+            raise ValueError("model.autocast keeps float32 weights and cannot be combined with model.float16")
 
         self.embedding = torch.nn.Embedding(ctx.dataset.classes, ctx.model.features * 2)
         self.embedding.weight.data.mul_(ctx.model.input_embedding_std * 2 ** -0.5)
 
         init_scale = ctx.model.depth ** -0.5
-        pos_embd = torch.arange(0, ctx.model.sequence_length).unsqueeze(0) + 1
-        self.register_buffer("divisor", pos_embd.unsqueeze(0).to(torch.float))
 
         momentum_coupling_forward, momentum_coupling_inverse = get_coupling(ctx.model.momentumnet_beta)
         self.stem = revlib.ReversibleSequential(*([layer
                                                    for _ in range(ctx.model.depth)
-                                                   for layer in [LinearAttentionCell(self, ctx, init_scale),
+                                                   for layer in [LinearAttentionCell(ctx, init_scale),
                                                                  torch.nn.Identity()]]),
                                                 coupling_forward=[momentum_coupling_forward,
                                                                   revlib.additive_coupling_forward],
@@ -120,6 +126,7 @@ class LinearAttention(torch.nn.Module):
                                                                   revlib.additive_coupling_inverse])
         self.output = torch.nn.Conv1d(ctx.model.features * 2, ctx.dataset.classes, (1,))
         torch.nn.init.zeros_(self.output.weight.data)
+        self.register_load_state_dict_pre_hook(_drop_legacy_divisor)
 
     def forward(self, inp: torch.Tensor, tgt: torch.Tensor):
         out = self.output(self.stem(self.embedding(inp).transpose(1, 2)))
@@ -129,18 +136,21 @@ class LinearAttention(torch.nn.Module):
 
 
 class LinearAttentionCell(torch.nn.Module):
-    def __init__(self, base: LinearAttention, ctx: Context, init_scale: float):
+    def __init__(self, ctx: Context, init_scale: float):
         super(LinearAttentionCell, self).__init__()
-        self.divisor = lambda: base.divisor
+        pos_embd = torch.arange(1, ctx.model.sequence_length + 1, dtype=torch.float)
+        self.register_buffer("inv_divisor", (1 / pos_embd).view(1, 1, -1), persistent=False)  # one copy per cell
         self.init_scale = init_scale
         self.caching = ctx.eval.cache
+        self.autocast = ctx.model.autocast
         self.kernel_size = ctx.model.conv_kernel_size
         self.groups = 3  # number of splits in ff
         self.dropout_probability = 1 - ctx.model.dropout_probability
         intermediate = int(ctx.model.features * ctx.model.feed_forward_intermediate_factor) * self.groups
         self.w0 = conv_weight(ctx.model.features, intermediate, 1, 1, ctx.model.activation_std)
-        self.w1 = conv_weight(intermediate, intermediate, ctx.model.conv_kernel_size, 3, ctx.model.activation_std)
-        self.w2 = conv_weight(intermediate, ctx.model.features * self.groups, 1, 3, 1)
+        self.w1 = conv_weight(intermediate, intermediate, ctx.model.conv_kernel_size, self.groups,
+                              ctx.model.activation_std)
+        self.w2 = conv_weight(intermediate, ctx.model.features * self.groups, 1, self.groups, 1)
         # Below is done to ignore pytorch's errors when calling .register_buffer without giving up the IDEs autocomplete
         self.idx: int = 0
         self._input_cache = torch.zeros([])
@@ -156,10 +166,16 @@ class LinearAttentionCell(torch.nn.Module):
         self.idx = 0
 
     def forward(self, inp: torch.Tensor) -> torch.Tensor:
-        self._input_cache, self._cumsum_cache, out = linear_attention(inp, self.divisor(), self.w0, self.w1, self.w2,
-                                                                      self.init_scale, self._cumsum_cache,
-                                                                      self.dropout_probability, self.training,
-                                                                      self.groups, self.caching,
-                                                                      self._input_cache, self.idx)
-        self.idx += 1
+        # Autocast lives inside the cell so revlib's recomputation in backward runs with the same precision
+        # nullcontext rather than enabled=False, so an autocast region opened by the caller stays active
+        context = (torch.autocast(device_type=inp.device.type, dtype=torch.bfloat16) if self.autocast
+                   else contextlib.nullcontext())
+        with context:
+            input_cache, cumsum_cache, out = linear_attention(inp, self.inv_divisor, self.w0, self.w1, self.w2,
+                                                              self.init_scale, self._cumsum_cache,
+                                                              self.dropout_probability, self.training, self.groups,
+                                                              self.caching, self._input_cache, self.idx)
+        if not self.training and self.caching:  # keep the training step free of Python-side state updates
+            self._input_cache, self._cumsum_cache = input_cache, cumsum_cache
+            self.idx += 1
         return out
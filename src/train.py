@@ -22,8 +22,8 @@ def main(ctx: Context, steps=None):
     curr_loss = torch.zeros([], device=ctx.model.device, dtype=dtype)
     start_time = time.time()
     for i, (src, tgt) in enumerate(data, 1):
-        lss = mod(src.squeeze(0).to(device=ctx.model.device, non_blocking=True),
-                  tgt.squeeze(0).to(device=ctx.model.device, non_blocking=True))
+        lss = mod(src.squeeze(0).to(device=ctx.model.device, non_blocking=True).long(),
+                  tgt.squeeze(0).to(device=ctx.model.device, non_blocking=True).long())
         mod.backward(lss)
         with torch.no_grad():
             mod.step()